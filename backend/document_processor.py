@@ -1,12 +1,28 @@
 from google import genai
 from google.genai import types
-import base64
-from dataclasses import dataclass
-from typing import Optional, List, Literal, Dict, Any, Union
+from dataclasses import dataclass, asdict
+from typing import Optional, List, Literal, Dict, Any, Union, Tuple, get_args
 import json
-from collections import defaultdict
+import orjson
+from collections import defaultdict, OrderedDict
 from schemas import schema_map
+from pdf_render import count_pages, render_page
+from pydantic import BaseModel, Field
+import asyncio
+import glob
 import io
+import os
+import hashlib
+import threading
+import time
+import mmap
+import multiprocessing
+import tempfile
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+import httpx
+from PIL import Image, ImageFilter, ImageOps, ImageStat
 
 # Original document types remain the same
 DocumentType = Literal[
@@ -22,19 +38,274 @@ DocumentType = Literal[
     "unknown"
 ]
 
-DOCUMENT_TYPES = [
-    "DoctorLetter", 
-    "HospitalLetter",
-    "LabReport", 
-    "MedicationBox", 
-    "MedicationDescription", 
-    "InsuranceCard", 
-    "VaccinationPass",
-    "MedicationPlan", 
-    "Prescription"
+# Types the model can choose from, derived from DocumentType so the two cannot drift apart
+DOCUMENT_TYPES = [t for t in get_args(DocumentType) if t != "unknown"]
+
+OCR_CACHE_FOLDER = "ocr_cache"
+
+_DOCUMENT_TYPE_LIST = ", ".join(f"- {t}" for t in DOCUMENT_TYPES)
+
+# Formatted with the number of images in the request
+TRIAGE_BATCH_PROMPT = f"""
+Analyze each of these {{count}} medical document images independently.
+For every image, determine its type. Possible types are:
+{_DOCUMENT_TYPE_LIST}
+
+Also check every image for quality issues that might affect optical character recognition:
+blurriness, poor lighting or low contrast, partial coverage, obstructions or shadows,
+skewed or rotated perspective, and folded or crumpled documents.
+
+Return one entry per image, using the image number given before it.
+"""
+
+SAFETY_SETTINGS = [
+    types.SafetySetting(
+        category="HARM_CATEGORY_HATE_SPEECH",
+        threshold="OFF"
+    ),
+    types.SafetySetting(
+        category="HARM_CATEGORY_DANGEROUS_CONTENT",
+        threshold="OFF"
+    ),
+    types.SafetySetting(
+        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        threshold="OFF"
+    ),
+    types.SafetySetting(
+        category="HARM_CATEGORY_HARASSMENT",
+        threshold="OFF"
+    )
 ]
 
-@dataclass
+# Triage response models. google-genai turns them into response schemas and validates
+# the replies into instances, which also rejects document types outside DOCUMENT_TYPES.
+class AnalysisResult(BaseModel):
+    document_type: Literal[tuple(DOCUMENT_TYPES)]
+    confidence: float = Field(description="Confidence score between 0 and 1 for the classification")
+    is_processable: bool = Field(description="Whether the image quality is sufficient for OCR")
+    quality_issues: List[str] = Field(description="List of detected quality issues")
+    confidence_score: float = Field(description="Confidence score between 0 and 1 for successful OCR")
+
+class TriageEntry(AnalysisResult):
+    image_number: int = Field(description="Number of the image this entry describes")
+
+class TriageBatchResult(BaseModel):
+    images: List[TriageEntry]
+
+# Number of pages categorized and quality-checked together in one Gemini request
+TRIAGE_BATCH_SIZE = 8
+
+# Output token limit for the triage reply of a single image
+TRIAGE_MAX_OUTPUT_TOKENS = 512
+
+# Limits for Gemini requests. The rate applies to all Gemini requests of the server process
+# together (OCR and onboarding), so a single worker stays below the Vertex AI quota.
+OCR_MAX_CONCURRENCY = 16
+GEMINI_REQUESTS_PER_MINUTE = 500
+
+class RateLimiter:
+    """Thread-safe token bucket allowing up to `rate` calls per `period` seconds, in bursts"""
+    
+    def __init__(self, rate: int, period: float = 60.0):
+        self.capacity = rate
+        self._refill_per_second = rate / period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """Take a token, blocking only while the bucket is empty"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self._refill_per_second)
+            self._updated = now
+            # Callers that find the bucket empty reserve a future token, so they start in order
+            self._tokens -= 1
+            delay = -self._tokens / self._refill_per_second
+        if delay > 0:
+            time.sleep(delay)
+
+gemini_rate_limiter = RateLimiter(GEMINI_REQUESTS_PER_MINUTE)
+
+# Threads for the blocking Gemini SDK calls. Only coroutines wait on these, never other
+# pool threads, and abandoned calls don't hold up asyncio.run the way the default executor does.
+_gemini_executor = ThreadPoolExecutor(max_workers=2 * OCR_MAX_CONCURRENCY, thread_name_prefix="gemini")
+
+# Number of per-image triage results kept in memory, keyed by image digest
+TRIAGE_CACHE_SIZE = 1024
+
+# Number of extraction responses kept in memory, keyed by page digests and document type
+EXTRACTION_CACHE_SIZE = 256
+
+# Number of whole-upload results kept in memory in front of the on-disk OCR cache
+RESULT_CACHE_SIZE = 64
+
+class LRUCache:
+    """Thread-safe mapping of bounded size that evicts the least recently used entry"""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+    
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+def _image_digest(image_bytes: bytes) -> bytes:
+    """Content digest of a page image, used for the in-memory caches"""
+    return hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+# Render PDF pages at 144 DPI (pdfium's base resolution is 72 DPI)
+PDF_RENDER_SCALE = 2
+
+# Gemini downsamples larger images anyway, so there is no point in uploading more pixels
+MAX_IMAGE_SIDE = 1568
+
+JPEG_QUALITY = 85
+
+# Rendered pages already fit MAX_IMAGE_SIDE, so _prepare_image passes them through unchanged
+_render_pdf_page = partial(render_page, scale=PDF_RENDER_SCALE, max_side=MAX_IMAGE_SIDE, quality=JPEG_QUALITY)
+
+def _flatten_to_rgb(image: Image.Image) -> Image.Image:
+    """Convert an image to RGB, placing transparent areas on white rather than black"""
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+def _prepare_image(image_bytes: bytes) -> bytes:
+    """Downscale an image to at most MAX_IMAGE_SIDE pixels per side and re-encode it as JPEG"""
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+    except Exception:
+        return image_bytes
+    
+    # Small JPEGs are sent as-is to avoid a lossy re-encode
+    if image.format == "JPEG" and max(image.size) <= MAX_IMAGE_SIDE:
+        return image_bytes
+    
+    # Apply the EXIF rotation of phone photos before the metadata is dropped
+    image = ImageOps.exif_transpose(image)
+    image = _flatten_to_rgb(image)
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+    
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=JPEG_QUALITY)
+    return buffer.getvalue()
+
+# Thresholds for the local quality pre-check. They are deliberately loose so that only
+# pages which are clearly unusable are rejected without asking Gemini.
+MIN_IMAGE_SIDE = 300
+MIN_SHARPNESS = 3
+MIN_CONTRAST = 10
+
+# Sharpness and contrast are measured per tile of this grid and the best tile counts, so
+# a sharp document in a mostly plain frame, or a page with a single line of text, isn't
+# mistaken for a blurred or blank one
+QUALITY_GRID = 8
+
+# Laplacian edge filter; offset keeps negative responses inside the 8-bit range
+_LAPLACIAN = ImageFilter.Kernel((3, 3), [0, 1, 0, 1, -4, 1, 0, 1, 0], scale=1, offset=128)
+
+def _tile_stats(image: Image.Image) -> List[ImageStat.Stat]:
+    """Statistics of every tile of a QUALITY_GRID grid over a grayscale image"""
+    width, height = image.size
+    return [
+        ImageStat.Stat(image.crop((
+            width * column // QUALITY_GRID,
+            height * row // QUALITY_GRID,
+            width * (column + 1) // QUALITY_GRID,
+            height * (row + 1) // QUALITY_GRID,
+        )))
+        for row in range(QUALITY_GRID)
+        for column in range(QUALITY_GRID)
+    ]
+
+def _sharpness(image: Image.Image) -> float:
+    """Laplacian variance of the sharpest tile of a grayscale image"""
+    # The filter copies the outermost pixels unfiltered, so they are cropped off
+    edges = image.filter(_LAPLACIAN).crop((1, 1, image.width - 1, image.height - 1))
+    return max(stat.var[0] for stat in _tile_stats(edges))
+
+def _contrast(image: Image.Image) -> float:
+    """Brightness standard deviation of the most contrasted tile of a grayscale image"""
+    return max(stat.stddev[0] for stat in _tile_stats(image))
+
+def local_quality_issues(image_bytes: bytes) -> List[str]:
+    """Detect obvious quality problems (tiny, blurred or blank images) without a Gemini call"""
+    try:
+        image = Image.open(io.BytesIO(image_bytes)).convert("L")
+    except Exception as e:
+        return [f"Image could not be decoded: {str(e)}"]
+    
+    if min(image.size) < MIN_IMAGE_SIDE:
+        return ["Image resolution too low"]
+    
+    issues = []
+    if _sharpness(image) < MIN_SHARPNESS:
+        issues.append("Blurriness")
+    if _contrast(image) < MIN_CONTRAST:
+        issues.append("Poor lighting or low contrast")
+    return issues
+
+@contextmanager
+def _map_file(path: str):
+    """Memory-map a file read-only so it can be hashed without reading it into memory"""
+    with open(path, "rb") as f:
+        # Empty files cannot be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+_pdf_render_pool = None
+_pdf_render_pool_lock = threading.Lock()
+
+def _get_pdf_render_pool() -> ProcessPoolExecutor:
+    """Process pool shared by all PDF uploads, started on first use"""
+    global _pdf_render_pool
+    with _pdf_render_pool_lock:
+        if _pdf_render_pool is None:
+            # Workers are spawned rather than forked, since forking the threaded server
+            # process can leave locks held by other threads locked in the child. They
+            # only import pdf_render, plus the __main__ module (see main.py).
+            _pdf_render_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pdf_render_pool
+
+def split_pdf_pages(pdf_bytes: bytes) -> List[bytes]:
+    """Render every page of a PDF to JPEG bytes, fanning pages out across CPU cores"""
+    # Rendering is CPU-bound, so use processes rather than threads. PDFium is not thread-safe,
+    # even across documents, so every PDFium call, page counting included, runs in the render
+    # workers, never in the server threads. Workers open the PDF from a temporary file, so only
+    # its path is sent with each task; map keeps page order
+    fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(pdf_bytes)
+        pool = _get_pdf_render_pool()
+        page_count = pool.submit(count_pages, pdf_path).result()
+        return list(pool.map(_render_pdf_page, [pdf_path] * page_count, range(page_count)))
+    finally:
+        os.remove(pdf_path)
+
+@dataclass(slots=True)
 class PageResult:
     """Result for a single page"""
     page_number: int
@@ -44,292 +315,317 @@ class PageResult:
     quality_issues: List[str]
     extracted_data: Optional[Dict[str, Any]] = None
 
-@dataclass
+@dataclass(slots=True)
 class DocumentGroup:
     """Group of pages of the same document type"""
     document_type: DocumentType
     page_results: List[PageResult]
     combined_data: Optional[Dict[str, Any]] = None
     
-@dataclass
+@dataclass(slots=True)
 class MultiDocumentResult:
     """Result containing multiple document groups from a set of pages"""
     document_groups: Dict[DocumentType, DocumentGroup]
     total_pages: int
     processable_pages: int
 
+# Retry transient failures (429, 5xx, timeouts) inside the client, with exponential
+# backoff and jitter, so one flaky request doesn't fail a whole page or upload
+GEMINI_RETRY_OPTIONS = types.HttpRetryOptions(
+    attempts=4,
+    initial_delay=0.5,
+    max_delay=8.0,
+)
+
+# The client keeps one pooled httpx connection per host, but httpx only keeps 20
+# idle connections alive by default; size it to the Gemini worker pool so each
+# worker thread can reuse a warm TLS connection instead of re-handshaking
+GEMINI_HTTP_LIMITS = httpx.Limits(
+    max_connections=4 * OCR_MAX_CONCURRENCY,
+    max_keepalive_connections=2 * OCR_MAX_CONCURRENCY,
+    keepalive_expiry=60.0,
+)
+
+@lru_cache(maxsize=None)
+def get_genai_client() -> genai.Client:
+    """Create the Vertex AI Gemini client on first use and reuse it afterwards"""
+    return genai.Client(
+        vertexai=True,
+        project="avi-cdtm-hack-team-9800",
+        location="us-central1",
+        http_options=types.HttpOptions(
+            retry_options=GEMINI_RETRY_OPTIONS,
+            client_args={"limits": GEMINI_HTTP_LIMITS},
+        ),
+    )
+
 class AgentOCR:
     def __init__(self):
-        self.client = genai.Client(
-            vertexai=True,
-            project="avi-cdtm-hack-team-9800",
-            location="us-central1",
-        )
+        self.client = get_genai_client()
         self.types = DOCUMENT_TYPES
         self.model = "gemini-2.0-flash-001"
+        # Categorization and quality checks return a few fields, so a smaller, faster model suffices
+        self.triage_model = "gemini-2.0-flash-lite-001"
         self.check_quality = False
         
+        # LRUs of results so repeated pages skip the Gemini round-trip
+        self._triage_cache = LRUCache(TRIAGE_CACHE_SIZE)
+        self.extraction_cache = LRUCache(EXTRACTION_CACHE_SIZE)
+        
         # Initialize schema dictionary for different document types
         self._init_schemas()
         
-    def _init_schemas(self):
-        """Initialize schema definitions for different document types"""
-        # Lab Report Schema
+        # The triage schema never changes, so its config is built once. Its replies are short,
+        # so it gets a tight output limit that still leaves room for the issue lists.
+        self.triage_config = self.generate_config(
+            temperature=0.2,
+            schema=TriageBatchResult,
+            max_output_tokens=TRIAGE_MAX_OUTPUT_TOKENS * TRIAGE_BATCH_SIZE
+        )
         
+    def _init_schemas(self):
+        """Initialize the extraction configs for the different document types"""
+        self.extraction_configs = {
+            doc_type: self.generate_config(temperature=0.2, schema=schema)
+            for doc_type, schema in schema_map.items()
+        }
     
-    def generate_config(self, temperature: float, schema: Optional[dict] = None) -> types.GenerateContentConfig:
+    def generate_config(
+        self,
+        temperature: float,
+        schema: Optional[Union[dict, type]] = None,
+        max_output_tokens: int = 8192
+    ) -> types.GenerateContentConfig:
         """Generate configuration for the content generation API"""
         generate_content_config = types.GenerateContentConfig(
             temperature=temperature,
             top_p=0.95,
             seed=0,
-            max_output_tokens=8192,
+            max_output_tokens=max_output_tokens,
             response_modalities=["TEXT"],
-            safety_settings=[
-                types.SafetySetting(
-                    category="HARM_CATEGORY_HATE_SPEECH",
-                    threshold="OFF"
-                ),
-                types.SafetySetting(
-                    category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                    threshold="OFF"
-                ),
-                types.SafetySetting(
-                    category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                    threshold="OFF"
-                ),
-                types.SafetySetting(
-                    category="HARM_CATEGORY_HARASSMENT",
-                    threshold="OFF"
-                )
-            ],
+            safety_settings=SAFETY_SETTINGS,
             response_mime_type="application/json",
             response_schema=schema,
         )
         
         return generate_content_config
         
-    def categorize(self, image_bytes):
-        """Categorize the document image"""
-        base64_image = base64.b64encode(image_bytes).decode("utf-8")
-        
-        prompt = f"""
-        Analyze this medical document image and determine its type.
-        Possible types are:
-        {", ".join(f"- {t}" for t in self.types)}
-        
-        Return the document type and your confidence level in the classification.
-        """
-        
-        categorization_schema = {
-            "type": "OBJECT",
-            "properties": {
-                "document_type": {
-                    "type": "STRING",
-                    "enum": self.types
-                },
-                "confidence": {
-                    "type": "NUMBER",
-                    "description": "Confidence score between 0 and 1"
-                },
-                "reasoning": {
-                    "type": "STRING",
-                    "description": "Brief explanation for the classification"
-                }
-            },
-            "required": ["document_type", "confidence"]
-        }
+    def _generate_content(self, model: str, contents: list, config: types.GenerateContentConfig):
+        """Send a Gemini request once the process-wide rate limit allows it"""
+        gemini_rate_limiter.acquire()
+        return self.client.models.generate_content(model=model, contents=contents, config=config)
+    
+    def _image_part(self, image_bytes: bytes) -> types.Part:
+        """Wrap JPEG bytes in a Part"""
+        return types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg")
+    
+    def _triage_result(self, result: AnalysisResult) -> Tuple[DocumentType, float, bool, List[str], float]:
+        """Turn a combined categorization and quality response into a triage tuple"""
+        if not self.check_quality:
+            return result.document_type, result.confidence, True, [], 1.0
+        return (
+            result.document_type,
+            result.confidence,
+            result.is_processable,
+            result.quality_issues,
+            result.confidence_score
+        )
+    
+    def _triage_key(self, image_bytes: bytes) -> tuple:
+        """Cache key for an image's triage result; quality results only apply with check_quality on"""
+        return _image_digest(image_bytes), self.check_quality
+    
+    def _get_cached_triage(self, key: tuple) -> Optional[Tuple[DocumentType, float, bool, List[str], float]]:
+        return self._triage_cache.get(key)
+    
+    def _cache_triage(self, key: tuple, result: Tuple[DocumentType, float, bool, List[str], float]) -> None:
+        # Unknown pages are failures; leave them out so they are retried
+        if result[0] == "unknown":
+            return
+        self._triage_cache.put(key, result)
+    
+    async def triage_pages_async(
+        self,
+        image_bytes_list: List[bytes],
+        max_concurrency: int = OCR_MAX_CONCURRENCY
+    ) -> List[Tuple[DocumentType, float, bool, List[str], float]]:
+        """Triage pages in batches of TRIAGE_BATCH_SIZE, with the batch requests in flight concurrently"""
+        semaphore = asyncio.Semaphore(max_concurrency)
+        loop = asyncio.get_running_loop()
+        
+        async def triage(batch):
+            async with semaphore:
+                return await loop.run_in_executor(_gemini_executor, self.triage_batch, batch)
+        
+        async def triage_chunk(start):
+            batch = image_bytes_list[start:start + TRIAGE_BATCH_SIZE]
+            try:
+                return await triage(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    return [("unknown", 0.0, False, [f"Categorization error: {str(e)}"], 0.0)]
+                print(f"Error categorizing pages {start + 1}-{start + len(batch)} together, retrying one by one: {str(e)}")
+            
+            # One bad page shouldn't fail the others, so each is retried in a request of its own
+            results = await asyncio.gather(*(triage([image_bytes]) for image_bytes in batch), return_exceptions=True)
+            return [
+                ("unknown", 0.0, False, [f"Categorization error: {str(result)}"], 0.0)
+                if isinstance(result, Exception) else result[0]
+                for result in results
+            ]
+        
+        chunks = await asyncio.gather(*(
+            triage_chunk(start) for start in range(0, len(image_bytes_list), TRIAGE_BATCH_SIZE)
+        ))
+        return [result for chunk in chunks for result in chunk]
+    
+    def triage_pages(self, image_bytes_list: List[bytes]) -> List[Tuple[DocumentType, float, bool, List[str], float]]:
+        """Synchronous wrapper around triage_pages_async"""
+        return asyncio.run(self.triage_pages_async(image_bytes_list))
+    
+    def triage_batch(self, image_bytes_list: List[bytes]) -> List[Tuple[DocumentType, float, bool, List[str], float]]:
+        """Categorize and quality-check several images, requesting only those not already cached"""
+        keys = [self._triage_key(image_bytes) for image_bytes in image_bytes_list]
+        results = [self._get_cached_triage(key) for key in keys]
+        
+        if self.check_quality:
+            # Reject clearly unusable pages locally instead of sending them along
+            for i, result in enumerate(results):
+                if result is None:
+                    quality_issues = local_quality_issues(image_bytes_list[i])
+                    if quality_issues:
+                        results[i] = "unknown", 0.0, False, quality_issues, 0.0
+        
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            fetched = self._request_triage_batch([image_bytes_list[i] for i in missing])
+            for i, result in zip(missing, fetched):
+                results[i] = result
+                self._cache_triage(keys[i], result)
+        return results
+    
+    def _request_triage_batch(self, image_bytes_list: List[bytes]) -> List[Tuple[DocumentType, float, bool, List[str], float]]:
+        """Categorize and quality-check several images with a single Gemini request"""
+        content_parts = [types.Part.from_text(text=TRIAGE_BATCH_PROMPT.format(count=len(image_bytes_list)))]
+        for image_number, image_bytes in enumerate(image_bytes_list, start=1):
+            content_parts.append(types.Part.from_text(text=f"\nImage {image_number}:"))
+            content_parts.append(self._image_part(image_bytes))
+        
+        response = self._generate_content(
+            model=self.triage_model,
+            contents=content_parts,
+            config=self.triage_config
+        )
         
-        content_parts = [
-            {"text": prompt},
-            {
-                "inline_data": {
-                    "mime_type": "image/jpeg",
-                    "data": base64_image
-                }
-            }
-        ]
+        if response.parsed is None:
+            raise ValueError(f"Response does not match the triage schema: {response.text}")
         
-        categorization_config = self.generate_config(temperature=0.2, schema=categorization_schema)
+        results = {result.image_number: result for result in response.parsed.images}
+        if sorted(results) != list(range(1, len(image_bytes_list) + 1)):
+            raise ValueError(f"Triage returned entries for images {sorted(results)}, expected {len(image_bytes_list)}")
         
-        try:
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=content_parts,
-                config=categorization_config
-            )
-            
-            result = json.loads(response.text)
-            doc_type = result.get("document_type")
-            confidence = result.get("confidence", 0.0)
+        return [self._triage_result(results[image_number]) for image_number in range(1, len(image_bytes_list) + 1)]
             
-            if doc_type not in self.types:
-                raise ValueError(f"Categorization returned unsupported type: {doc_type}")
-                
-            return doc_type, confidence
-        except Exception as e:
-            raise ValueError(f"Failed to parse categorization response: {e}")
-        
-    def check_image_quality(self, image_bytes):
-        """Check the quality of the image for OCR"""
-        base64_image = base64.b64encode(image_bytes).decode("utf-8")
+@lru_cache(maxsize=None)
+def get_ocr_agent() -> AgentOCR:
+    """Create the shared AgentOCR on first use, so its configs and caches live for the process"""
+    return AgentOCR()
+
+
+class MultiDocumentProcessor:
+    """Processes multiple pages, classifies them, and groups them by document type"""
+    
+    def __init__(self, cache_folder: Optional[str] = OCR_CACHE_FOLDER):
+        self.ocr_agent = get_ocr_agent()
+        self.cache_folder = cache_folder
+        # Serialized results, so every caller gets its own copy to modify
+        self._result_cache = LRUCache(RESULT_CACHE_SIZE)
+        if cache_folder:
+            os.makedirs(cache_folder, exist_ok=True)
+    
+    def _cache_key(self, image_bytes_list: List[Union[bytes, mmap.mmap]]) -> str:
+        """Content hash of an ordered list of pages"""
+        key = hashlib.blake2b(digest_size=16)
+        for image_bytes in image_bytes_list:
+            key.update(hashlib.blake2b(image_bytes, digest_size=16).digest())
+        return key.hexdigest()
+    
+    @staticmethod
+    def _is_complete(result: MultiDocumentResult) -> bool:
+        """Whether every page ended up in a document group with extracted data.
         
-        prompt = """
-        Analyze this medical document image and check for quality issues that might affect optical character recognition.
-        Check for the following issues:
-        1. Blurriness
-        2. Poor lighting or low contrast
-        3. Partial coverage (document cut off)
-        4. Obstructions or shadows
-        5. Skewed or rotated perspective
-        6. Folded or crumpled document
+        Pages that could not be categorized or processed (including failed Gemini requests)
+        are left out of the groups, so any missing page makes the result partial.
         """
-        
-        quality_schema = {
-            "type": "OBJECT",
-            "properties": {
-                "is_processable": {
-                    "type": "BOOLEAN",
-                    "description": "Whether the image quality is sufficient for OCR"
-                },
-                "quality_issues": {
-                    "type": "ARRAY",
-                    "items": {
-                        "type": "STRING"
-                    },
-                    "description": "List of detected quality issues"
-                },
-                "confidence_score": {
-                    "type": "NUMBER",
-                    "description": "Confidence score between 0 and 1 for successful OCR"
-                }
-            },
-            "required": ["is_processable", "quality_issues", "confidence_score"]
-        }
-        
-        content_parts = [
-            {"text": prompt},
-            {
-                "inline_data": {
-                    "mime_type": "image/jpeg",
-                    "data": base64_image
-                }
-            }
-        ]
-        
-        quality_config = self.generate_config(temperature=0.2, schema=quality_schema)
-        
+        groups = result.document_groups.values()
+        return (
+            bool(groups)
+            and sum(len(group.page_results) for group in groups) == result.total_pages
+            and all(group.combined_data is not None for group in groups)
+        )
+    
+    def _load_cached_result(self, cache_key: str) -> Optional[MultiDocumentResult]:
+        """Load a previously stored result for the same pages from memory or disk, if any"""
         try:
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=content_parts,
-                config=quality_config
-            )
-            
-            quality_result = json.loads(response.text)
+            data = self._result_cache.get(cache_key)
+            if data is None:
+                if not self.cache_folder:
+                    return None
+                cache_path = os.path.join(self.cache_folder, f"{cache_key}.json")
+                if not os.path.exists(cache_path):
+                    return None
+                with open(cache_path, "rb") as f:
+                    data = f.read()
+                self._result_cache.put(cache_key, data)
             
-            return (
-                quality_result.get("is_processable", False),
-                quality_result.get("quality_issues", []),
-                quality_result.get("confidence_score", 0.0)
+            data = orjson.loads(data)
+            result = MultiDocumentResult(
+                document_groups={
+                    doc_type: DocumentGroup(
+                        document_type=group["document_type"],
+                        page_results=[PageResult(**page) for page in group["page_results"]],
+                        combined_data=group["combined_data"]
+                    )
+                    for doc_type, group in data["document_groups"].items()
+                },
+                total_pages=data["total_pages"],
+                processable_pages=data["processable_pages"]
             )
+            # Partial results stored by older versions are processed again
+            return result if self._is_complete(result) else None
         except Exception as e:
-            return False, [f"Error checking image quality: {str(e)}"], 0.0
-            
-    def extract_data(self, image_bytes: bytes, doc_type: DocumentType) -> Dict[str, Any]:
-        """Extract structured data from an image based on document type"""
-        schema = schema_map.get(doc_type)
-        if not schema:
-            raise ValueError(f"No extraction schema defined for document type: {doc_type}")
-        
-        base64_image = base64.b64encode(image_bytes).decode("utf-8")
-        
-        prompt = f"Extract all data from this {doc_type} image according to the provided schema."
-        
-        content_parts = [
-            {"text": prompt},
-            {
-                "inline_data": {
-                    "mime_type": "image/jpeg",
-                    "data": base64_image
-                }
-            }
-        ]
+            print(f"Error loading cached OCR result {cache_key}: {e}")
+            return None
+    
+    def _store_cached_result(self, cache_key: str, result: MultiDocumentResult) -> None:
+        """Store a result in memory and on disk, skipping partial ones so failed pages are retried next time"""
+        if not self._is_complete(result):
+            return
         
-        extraction_config = self.generate_config(temperature=0.2, schema=schema)
+        data = orjson.dumps(asdict(result))
+        self._result_cache.put(cache_key, data)
+        if not self.cache_folder:
+            return
         
+        cache_path = os.path.join(self.cache_folder, f"{cache_key}.json")
         try:
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=content_parts,
-                config=extraction_config
-            )
-            
-            extracted_data = json.loads(response.text)
-            return extracted_data
-            
-        except Exception as e:
-            raise ValueError(f"Error extracting data from {doc_type}: {str(e)}")
-    
-    def process_page(self, image_bytes: bytes, page_number: int) -> PageResult:
-        """Process a single page: categorize, check quality, and extract data"""
-        try:
-            # First check image quality
-            is_processable = True
-            quality_issues = []
-            quality_confidence = 1.0
-            if self.check_quality:
-                is_processable, quality_issues, quality_confidence = self.check_image_quality(image_bytes)
-            
-            # Then categorize the image
-            doc_type, classification_confidence = self.categorize(image_bytes)
-            
-            # Combine quality and classification confidence
-            combined_confidence = (quality_confidence + classification_confidence) / 2
-            
-            # Extract data if the image is processable
-            extracted_data = None
-            if is_processable:
-                try:
-                    extracted_data = self.extract_data(image_bytes, doc_type)
-                except Exception as e:
-                    quality_issues.append(f"Data extraction failed: {str(e)}")
-            
-            return PageResult(
-                page_number=page_number,
-                detected_type=doc_type,
-                confidence_score=combined_confidence,
-                is_processable=is_processable,
-                quality_issues=quality_issues,
-                extracted_data=extracted_data
-            )
-            
+            with open(cache_path, "wb") as f:
+                f.write(data)
         except Exception as e:
-            return PageResult(
-                page_number=page_number,
-                detected_type="unknown",
-                confidence_score=0.0,
-                is_processable=False,
-                quality_issues=[f"Processing error: {str(e)}"],
-                extracted_data=None
-            )
-
-
-class MultiDocumentProcessor:
-    """Processes multiple pages, classifies them, and groups them by document type"""
-    
-    def __init__(self):
-        self.ocr_agent = AgentOCR()
+            print(f"Error caching OCR result {cache_key}: {e}")
         
 
     def process_document_batch(self, doc_type: DocumentType, image_bytes_list: List[bytes], page_numbers: List[int]) -> Dict[str, Any]:
         """Process all pages of the same document type together"""
-        schema = schema_map.get(doc_type)
-        if not schema:
+        extraction_config = self.ocr_agent.extraction_configs.get(doc_type)
+        if extraction_config is None:
             raise ValueError(f"No extraction schema defined for document type: {doc_type}")
         
-        # Convert all images to base64
-        base64_images = [base64.b64encode(img).decode("utf-8") for img in image_bytes_list]
+        # Page numbers are part of the prompt, so they are part of the key
+        cache_key = (doc_type, tuple(map(_image_digest, image_bytes_list)), tuple(page_numbers))
+        cached = self.ocr_agent.extraction_cache.get(cache_key)
+        if cached is not None:
+            return orjson.loads(cached)
         
         # Build multi-page prompt
         prompt = f"""
@@ -340,35 +636,29 @@ class MultiDocumentProcessor:
         """
         
         # Create content parts with all images
-        content_parts = [{"text": prompt}]
-        for i, b64_img in enumerate(base64_images):
-            content_parts.append({
-                "text": f"\nPage {page_numbers[i]}:"
-            })
-            content_parts.append({
-                "inline_data": {
-                    "mime_type": "image/jpeg",
-                    "data": b64_img
-                }
-            })
-        
-        extraction_config = self.ocr_agent.generate_config(temperature=0.2, schema=schema)
+        content_parts = [types.Part.from_text(text=prompt)]
+        for page_number, image_bytes in zip(page_numbers, image_bytes_list):
+            content_parts.append(types.Part.from_text(text=f"\nPage {page_number}:"))
+            content_parts.append(self.ocr_agent._image_part(image_bytes))
         
         try:
-            response = self.ocr_agent.client.models.generate_content(
+            response = self.ocr_agent._generate_content(
                 model=self.ocr_agent.model,
                 contents=content_parts,
                 config=extraction_config
             )
             
-            extracted_data = json.loads(response.text)
+            extracted_data = response.parsed
+            if extracted_data is None:
+                raise ValueError(f"Response is not valid JSON: {response.text}")
+            self.ocr_agent.extraction_cache.put(cache_key, response.text)
             return extracted_data
             
         except Exception as e:
             raise ValueError(f"Error batch processing {doc_type} pages: {str(e)}")
 
     def process_pages(self, image_bytes_list: List[bytes]) -> MultiDocumentResult:
-        """Process a list of page images with batch processing for each document type"""
+        """Process a list of page images, reusing the stored result for identical uploads"""
         if not image_bytes_list:
             return MultiDocumentResult(
                 document_groups={},
@@ -376,244 +666,136 @@ class MultiDocumentProcessor:
                 processable_pages=0
             )
         
-        # First, categorize each page individually
-        page_categories = []
-        for page_num, image_bytes in enumerate(image_bytes_list, start=1):
-            try:
-                doc_type, confidence = self.ocr_agent.categorize(image_bytes)
-                
-                # Check if the image is processable
-                is_processable = True
-                quality_issues = []
-                if self.ocr_agent.check_quality:
-                    is_processable, quality_issues, _ = self.ocr_agent.check_image_quality(image_bytes)
-                
-                page_categories.append({
-                    'page_number': page_num,
-                    'doc_type': doc_type,
-                    'confidence': confidence,
-                    'is_processable': is_processable,
-                    'quality_issues': quality_issues
-                })
-            except Exception as e:
-                print(f"Error categorizing page {page_num}: {str(e)}")
-                page_categories.append({
-                    'page_number': page_num,
-                    'doc_type': "unknown",
-                    'confidence': 0.0,
-                    'is_processable': False,
-                    'quality_issues': [f"Categorization error: {str(e)}"]
-                })
+        cache_key = self._cache_key(image_bytes_list)
+        result = self._load_cached_result(cache_key)
+        if result is None:
+            result = self._process_pages(image_bytes_list)
+            self._store_cached_result(cache_key, result)
+        return result
+
+    def process_files(self, paths: List[str]) -> MultiDocumentResult:
+        """Process page images stored on disk; cache hits are served without loading the files"""
+        if not paths:
+            return self.process_pages([])
+        
+        with ExitStack() as stack:
+            pages = [stack.enter_context(_map_file(path)) for path in paths]
+            cache_key = self._cache_key(pages)
+            result = self._load_cached_result(cache_key)
+            if result is None:
+                result = self._process_pages([page[:] for page in pages])
+                self._store_cached_result(cache_key, result)
+        return result
+
+    async def _extract_document_groups(
+        self,
+        doc_type_groups: Dict[DocumentType, List[int]],
+        image_bytes_list: List[bytes]
+    ) -> Dict[DocumentType, Union[Dict[str, Any], Exception]]:
+        """Batch-extract every document type concurrently; failures are returned, not raised"""
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(
+                _gemini_executor,
+                self.process_document_batch,
+                doc_type,
+                [image_bytes_list[idx] for idx in page_indices],
+                [idx + 1 for idx in page_indices]  # Convert back to 1-indexed
+            )
+            for doc_type, page_indices in doc_type_groups.items()
+        ), return_exceptions=True)
+        return dict(zip(doc_type_groups, results))
+
+    def _process_pages(self, image_bytes_list: List[bytes]) -> MultiDocumentResult:
+        """Process a list of page images with batch processing for each document type"""
+        image_bytes_list = [_prepare_image(image_bytes) for image_bytes in image_bytes_list]
         
-        # Group pages by document type
+        # First, categorize the pages, several at a time, grouping them by document type as we go
+        page_categories = []
         doc_type_groups = defaultdict(list)
-        for page_info in page_categories:
-            if page_info['is_processable'] and page_info['doc_type'] != "unknown":
-                doc_type_groups[page_info['doc_type']].append(page_info['page_number'] - 1)  # Convert to 0-indexed
+        processable_pages = 0
+        triaged = self.ocr_agent.triage_pages(image_bytes_list)
+        for page_num, (doc_type, confidence, is_processable, quality_issues, _) in enumerate(triaged, start=1):
+            page_categories.append({
+                'page_number': page_num,
+                'doc_type': doc_type,
+                'confidence': confidence,
+                'is_processable': is_processable,
+                'quality_issues': quality_issues
+            })
+            if is_processable:
+                processable_pages += 1
+                if doc_type != "unknown":
+                    doc_type_groups[doc_type].append(page_num - 1)  # Convert to 0-indexed
         
         # Process each document type as a batch
         document_groups = {}
-        processable_pages = sum(1 for page in page_categories if page['is_processable'])
+        
+        # The document types are independent, so their extraction requests run concurrently
+        extractions = asyncio.run(self._extract_document_groups(doc_type_groups, image_bytes_list))
         
         for doc_type, page_indices in doc_type_groups.items():
-            # Get the corresponding images
-            doc_images = [image_bytes_list[idx] for idx in page_indices]
-            page_numbers = [idx + 1 for idx in page_indices]  # Convert back to 1-indexed
-            
             # Process all pages of this document type together
-            try:
-                combined_data = self.process_document_batch(doc_type, doc_images, page_numbers)
-                
-                # Create individual page results
-                page_results = []
-                for i, page_idx in enumerate(page_indices):
-                    page_info = next(p for p in page_categories if p['page_number'] == page_idx + 1)
-                    
-                    # Create a single-page result but with the combined data
-                    page_result = PageResult(
-                        page_number=page_idx + 1,
-                        detected_type=doc_type,
-                        confidence_score=page_info['confidence'],
-                        is_processable=page_info['is_processable'],
-                        quality_issues=page_info['quality_issues'],
-                        extracted_data=combined_data if i == 0 else None  # Only include data for first page to avoid duplication
-                    )
-                    page_results.append(page_result)
-                
-                document_groups[doc_type] = DocumentGroup(
-                    document_type=doc_type,
-                    page_results=page_results,
-                    combined_data=combined_data
-                )
+            combined_data = extractions[doc_type]
+            extraction_issues = []
+            if isinstance(combined_data, Exception):
+                # Keep the triage results of the pages; only this type's data is missing
+                print(f"Error processing {doc_type} batch: {combined_data}")
+                extraction_issues = [f"Data extraction failed: {str(combined_data)}"]
+                combined_data = None
+            
+            # Create individual page results
+            page_results = []
+            for i, page_idx in enumerate(page_indices):
+                page_info = page_categories[page_idx]  # page_categories is in page order
                 
-            except Exception as e:
-                print(f"Error processing {doc_type} batch: {e}")
-                # Create empty group with error
-                document_groups[doc_type] = DocumentGroup(
-                    document_type=doc_type,
-                    page_results=[],
-                    combined_data=None
+                # Create a single-page result but with the combined data
+                page_result = PageResult(
+                    page_number=page_idx + 1,
+                    detected_type=doc_type,
+                    confidence_score=page_info['confidence'],
+                    is_processable=page_info['is_processable'],
+                    quality_issues=page_info['quality_issues'] + extraction_issues,
+                    extracted_data=combined_data if i == 0 else None  # Only include data for first page to avoid duplication
                 )
-        
-        return MultiDocumentResult(
-            document_groups=document_groups,
-            total_pages=len(image_bytes_list),
-            processable_pages=processable_pages
-        )    
-
-    def _group_pages_by_type(self, page_results: List[PageResult], image_bytes_list: List[bytes]) -> MultiDocumentResult:
-        """Group pages by document type and combine data for each group"""
-        # Count processable pages
-        processable_pages = sum(1 for result in page_results if result.is_processable)
-        
-        # Group by document type
-        groups = defaultdict(list)
-        for result in page_results:
-            groups[result.detected_type].append(result)
-            
-        # Create document groups with combined data
-        document_groups = {}
-        for doc_type, results in groups.items():
-            # Sort by page number
-            results.sort(key=lambda r: r.page_number)
-            
-            # Combine data for pages of this document type
-            combined_data = self._combine_data(results)
+                page_results.append(page_result)
             
             document_groups[doc_type] = DocumentGroup(
                 document_type=doc_type,
-                page_results=results,
+                page_results=page_results,
                 combined_data=combined_data
             )
-            
+        
         return MultiDocumentResult(
             document_groups=document_groups,
-            total_pages=len(page_results),
+            total_pages=len(image_bytes_list),
             processable_pages=processable_pages
         )
-    
-    def _combine_data(self, page_results: List[PageResult]) -> Dict[str, Any]:
-        """
-        General-purpose method to combine data from multiple pages
-        This method intelligently handles different field types
-        without needing document type-specific logic
-        """
-        # Filter pages with extracted data
-        pages_with_data = [p for p in page_results if p.extracted_data is not None]
-        
-        if not pages_with_data:
-            return None
-            
-        # Start with data from first page
-        combined = pages_with_data[0].extracted_data.copy()
-        
-        # Process each subsequent page
-        for page in pages_with_data[1:]:
-            page_data = page.extracted_data
-            if not page_data:
-                continue
-                
-            # Recursively merge data from this page
-            self._merge_dict(combined, page_data, page.page_number)
-            
-        return combined
-    
-    def _merge_dict(self, target: Dict[str, Any], source: Dict[str, Any], page_num: int) -> None:
-        """
-        Recursively merge source dictionary into target dictionary
-        
-        Args:
-            target: Target dictionary to merge into
-            source: Source dictionary to merge from
-            page_num: Page number for reference
-        """
-        for key, value in source.items():
-            # If key not in target, just add it
-            if key not in target:
-                target[key] = value
-                continue
-                
-            target_value = target[key]
-            
-            # Handle different value types
-            if isinstance(value, dict) and isinstance(target_value, dict):
-                # Recursively merge dictionaries
-                self._merge_dict(target_value, value, page_num)
-                
-            elif isinstance(value, list) and isinstance(target_value, list):
-                # Merge lists based on content type
-                if value and isinstance(value[0], dict) and "name" in value[0]:
-                    # List of named objects (like medications, test results, ingredients)
-                    self._merge_named_object_lists(target_value, value, page_num)
-                else:
-                    # For other lists, just extend
-                    target_value.extend(value)
-                    
-            elif isinstance(value, str) and isinstance(target_value, str):
-                # Concatenate string values if they're different
-                if value not in target_value:
-                    target[key] = f"{target_value}\n\n[Page {page_num}]\n{value}"
-            
-            # For other types, keep the target value (first page's value)
-    
-    def _merge_named_object_lists(self, target_list: List[Dict], source_list: List[Dict], page_num: int) -> None:
-        """
-        Merge lists of objects with 'name' field, avoiding duplicates
-        
-        Args:
-            target_list: Target list to merge into
-            source_list: Source list to merge from
-            page_num: Page number for reference
-        """
-        # Create a set of existing names for fast lookup
-        existing_names = {item.get("name").lower() for item in target_list 
-                         if isinstance(item, dict) and "name" in item}
-        
-        # Add items that don't exist in the target list
-        for item in source_list:
-            if not isinstance(item, dict) or "name" not in item:
-                target_list.append(item)
-                continue
-                
-            name = item.get("name").lower()
-            if name not in existing_names:
-                # Add page number reference
-                item["page"] = page_num
-                target_list.append(item)
-                existing_names.add(name)
-            else:
-                # If item exists, update any missing fields
-                existing_item = next(i for i in target_list if i.get("name").lower() == name)
-                for k, v in item.items():
-                    if k not in existing_item or not existing_item[k]:
-                        existing_item[k] = v
 
 
 # Example usage
 if __name__ == "__main__":
     processor = MultiDocumentProcessor()
     
-    image_bytes_list = []
-
-    # Load all 5 images
-    for i in range(1, 4):
-        try:
-            with open(f"data/doctor_letter/3/{i}.jpg", "rb") as f:
-                image_bytes = f.read()
-                image_bytes_list.append(image_bytes)
-        except Exception as e:
-            print(f"Error loading image {i}: {str(e)}")
-    
-    # Process single page medication
-    result = processor.process_pages(image_bytes_list)
-    
-    # Print results
-    print(f"Processed {result.total_pages} pages")
+    # Every folder holds the page images of one document
+    documents = {
+        folder: sorted(glob.glob(os.path.join(folder, "*.jpg")))
+        for folder in sorted(glob.glob("data/doctor_letter/*/"))
+    }
     
-    # Check for medication documents
-    for doc_type, group in result.document_groups.items():
-        print(f"\nDetected document type: {doc_type}")
+    # Submit all documents before waiting on any, so they are processed concurrently
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = {pool.submit(processor.process_files, paths): folder for folder, paths in documents.items()}
         
-        if group.combined_data:
-            print(f"Extracted data available for {doc_type}")
-            print(json.dumps(group.combined_data, indent=2))
\ No newline at end of file
+        for future in as_completed(futures):
+            result = future.result()
+            
+            # Print results
+            print(f"\n{futures[future]}: processed {result.total_pages} pages")
+            
+            for doc_type, group in result.document_groups.items():
+                print(f"\nDetected document type: {doc_type}")
+                
+                if group.combined_data:
+                    print(f"Extracted data available for {doc_type}")
+                    print(json.dumps(group.combined_data, indent=2))
@@ -1,20 +1,38 @@
 # backend/main.py
+import os
+import sys
+
+if __name__ == "__main__":
+    # Hand over to the uvicorn CLI, which imports this file as "main". Running the app setup
+    # below as __main__ would make the spawned PDF render workers, which re-import __main__
+    # on start-up, create the app, agents and Gemini clients as well.
+    # Sessions live in process memory unless SESSION_REDIS_URL is set, so this must stay
+    # a single worker without it
+    os.execv(sys.executable, [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+        "--host", "0.0.0.0", "--port", "8080",
+    ])
+
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+import asyncio
 import uuid
-import os
-from typing import Dict, List
+from typing import List
 from pydantic import BaseModel
 from models import OnboardingState, QuestionResponse, DocumentProcessResponse
-from document_processor import MultiDocumentProcessor
+from document_processor import MultiDocumentProcessor, split_pdf_pages
 from onboarding_agent import OnboardingAgent # Import the new agent
+from session_store import create_session_store
 from voice.llm import synthesize_speech, transcribe_audio_file
-import io
 import hashlib
+import re
 
-app = FastAPI(title="Medical Onboarding API")
+# Serialize responses with orjson; document responses carry large extracted_data payloads
+app = FastAPI(title="Medical Onboarding API", default_response_class=ORJSONResponse)
 
 # Configure CORS for frontend
 app.add_middleware(
@@ -28,6 +46,8 @@ app.add_middleware(
 # Configuration
 UPLOAD_FOLDER = "uploads"
 AUDIO_FOLDER = "audio_cache"
+UNSAFE_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9._-]+")
+MAX_FILENAME_LENGTH = 120
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(AUDIO_FOLDER, exist_ok=True)
 
@@ -40,14 +60,18 @@ document_processor = MultiDocumentProcessor()
 # Initialize the agent
 agent = OnboardingAgent(document_processor)
 
-# Mock database for user sessions (in production, use a real database)
-sessions: Dict[str, OnboardingState] = {}
+# User sessions, in process memory unless SESSION_REDIS_URL points to a shared Redis.
+# Handlers hold the session's lock from loading the state until saving it, since the agent
+# changes it in place from a worker thread; saving also restarts its expiry timer.
+sessions = create_session_store()
 
-def get_session(session_id: str) -> OnboardingState:
+async def get_session(session_id: str) -> OnboardingState:
     """Get or create a session"""
-    if session_id not in sessions:
-        sessions[session_id] = OnboardingState(id=session_id)
-    return sessions[session_id]
+    state = await sessions.get(session_id)
+    if state is None:
+        state = OnboardingState(id=session_id)
+        await sessions.put(state)
+    return state
 
 class AnswerRequest(BaseModel):
     answer: str
@@ -56,6 +80,36 @@ class EnhancedQuestionResponse(QuestionResponse):
     """Enhanced response that includes audio URL"""
     audio_url: str
 
+def safe_filename(filename: str) -> str:
+    """Strip path separators and other unsafe characters from an uploaded filename"""
+    stem, ext = os.path.splitext(UNSAFE_FILENAME_CHARS.sub("_", filename or ""))
+    # Shorten the name but keep the extension
+    ext = ext[:16]
+    return stem[:MAX_FILENAME_LENGTH - len(ext)] + ext or "upload"
+
+def save_upload(filepath: str, content: bytes) -> None:
+    """Write the reference copy of an upload; runs as a background task after the response"""
+    with open(filepath, "wb") as buffer:
+        buffer.write(content)
+        
+        # The saved copy is only kept for reference and never read back, so let the kernel
+        # drop it from the page cache (not available on macOS). Dirty pages are not dropped,
+        # so write them out first; this runs after the response and delays no request.
+        if hasattr(os, "posix_fadvise"):
+            buffer.flush()
+            os.fsync(buffer.fileno())
+            os.posix_fadvise(buffer.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def is_pdf(content: bytes) -> bool:
+    """Detect PDFs by their header; readers accept it anywhere in the first kilobyte"""
+    return b"%PDF-" in content[:1024]
+
+async def upload_pages(content: bytes) -> List[bytes]:
+    """Explode PDFs into one image per page so every page gets categorized on its own"""
+    if is_pdf(content):
+        return await run_in_threadpool(split_pdf_pages, content)
+    return [content]
+
 # Function to generate and cache audio
 def generate_audio_file(text: str) -> str:
     """Generate audio file from text and return the URL path"""
@@ -79,18 +133,21 @@ def generate_audio_file(text: str) -> str:
 async def create_session():
     """Create a new session"""
     session_id = str(uuid.uuid4())
-    sessions[session_id] = OnboardingState(id=session_id)
+    await get_session(session_id)
     return {"session_id": session_id}
 
 @app.get("/questions/{session_id}", response_model=EnhancedQuestionResponse)
 async def get_next_question(session_id: str, background_tasks: BackgroundTasks):
     """Get the next question with audio URL"""
-    state = get_session(session_id)
-    # Let the agent determine the next question/message
-    response = agent.get_next_question(state)
+    async with sessions.lock(session_id):
+        state = await get_session(session_id)
+        # Let the agent determine the next question/message. The agent and speech synthesis
+        # call remote models, so they run in the worker thread pool to keep the event loop free
+        response = await run_in_threadpool(agent.get_next_question, state)
+        await sessions.put(state)
     
     # Generate audio file and get its URL
-    audio_url = generate_audio_file(response.message)
+    audio_url = await run_in_threadpool(generate_audio_file, response.message)
     
     # Create enhanced response with audio URL
     enhanced_response = EnhancedQuestionResponse(
@@ -103,14 +160,15 @@ async def get_next_question(session_id: str, background_tasks: BackgroundTasks):
 @app.post("/answer/{session_id}")
 async def submit_answer(session_id: str, request: AnswerRequest):
     """Submit an answer to the current question"""
-    state = get_session(session_id)
-    # Let the agent process the answer
-    response = agent.process_answer(state, request.answer)
-    # Update the session state
-    sessions[session_id] = state
+    async with sessions.lock(session_id):
+        state = await get_session(session_id)
+        # Let the agent process the answer
+        # The agent updates the session state in place
+        response = await run_in_threadpool(agent.process_answer, state, request.answer)
+        await sessions.put(state)
     
     # Generate audio for the response
-    audio_url = generate_audio_file(response.message)
+    audio_url = await run_in_threadpool(generate_audio_file, response.message)
     
     # Create enhanced response with audio URL
     enhanced_response = EnhancedQuestionResponse(
@@ -127,21 +185,21 @@ async def submit_transcribed_answer(
     file: UploadFile = File(None)
 ):
     """Submit a text or audio answer"""
-    state = get_session(session_id)
-
     try:
         # 1. Get the answer from audio or form
         if file:
-            answer = transcribe_audio_file(file)
+            answer = await run_in_threadpool(transcribe_audio_file, file)
         elif not answer:
             raise HTTPException(status_code=400, detail="No input provided.")
 
         # 2. Process the answer
-        response = agent.process_answer(state, answer)
-        sessions[session_id] = state
+        async with sessions.lock(session_id):
+            state = await get_session(session_id)
+            response = await run_in_threadpool(agent.process_answer, state, answer)
+            await sessions.put(state)
         
         # Generate audio for the response
-        audio_url = generate_audio_file(response.message)
+        audio_url = await run_in_threadpool(generate_audio_file, response.message)
         
         # Create enhanced response with audio URL
         enhanced_response = EnhancedQuestionResponse(
@@ -155,39 +213,34 @@ async def submit_transcribed_answer(
         raise HTTPException(status_code=500, detail=f"Failed to process answer: {str(e)}")
 
 @app.post("/document/{session_id}")
-async def process_document(session_id: str, files: List[UploadFile] = File(...)):
+async def process_document(session_id: str, background_tasks: BackgroundTasks, files: List[UploadFile] = File(...)):
     """Process multiple uploaded documents at once"""
-    state = get_session(session_id)
-    
     # Process all files
     try:
-        # Collect all files
-        image_bytes_list = []
-        filenames = []
+        # Read all files at once; only the in-memory content is processed, and the copies
+        # on disk are written after the response
+        filenames = [f"{uuid.uuid4()}_{safe_filename(file.filename)}" for file in files]
+        contents = await asyncio.gather(*(file.read() for file in files))
+        for filename, content in zip(filenames, contents):
+            background_tasks.add_task(save_upload, os.path.join(UPLOAD_FOLDER, filename), content)
         
-        for file in files:
-            # Save the file
-            filename = f"{uuid.uuid4()}_{file.filename}"
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
+        # PDFs of different files are rendered concurrently; pages stay in upload order
+        pages = await asyncio.gather(*(upload_pages(content) for content in contents))
+        image_bytes_list = [page for file_pages in pages for page in file_pages]
+        
+        async with sessions.lock(session_id):
+            state = await get_session(session_id)
             
-            with open(filepath, "wb") as buffer:
-                file_content = await file.read()
-                buffer.write(file_content)
+            # Let the agent process all documents at once. OCR takes seconds, so run it
+            # in the worker thread pool to keep the event loop free for other sessions
+            doc_response = await run_in_threadpool(agent.process_documents, state, image_bytes_list, filenames)
             
-            # Read the saved file
-            with open(filepath, "rb") as f:
-                image_bytes = f.read()
-                image_bytes_list.append(image_bytes)
-                filenames.append(filename)
-        
-        # Let the agent process all documents at once
-        doc_response = agent.process_documents(state, image_bytes_list, filenames)
-        
-        # Get the next question to provide a message
-        question_response = agent.get_next_question(state)
+            # Get the next question to provide a message
+            question_response = await run_in_threadpool(agent.get_next_question, state)
+            await sessions.put(state)
         
         # Generate audio for the question response message
-        audio_url = generate_audio_file(question_response.message)
+        audio_url = await run_in_threadpool(generate_audio_file, question_response.message)
         
         # Create enhanced response with audio URL and document data
         enhanced_response = EnhancedQuestionResponse(
@@ -199,8 +252,6 @@ async def process_document(session_id: str, files: List[UploadFile] = File(...))
             audio_url=audio_url
         )
         
-        # Update the session state
-        sessions[session_id] = state
         return enhanced_response
     
     except Exception as e:
@@ -213,18 +264,13 @@ async def process_document(session_id: str, files: List[UploadFile] = File(...))
 @app.get("/state/{session_id}")
 async def get_session_state(session_id: str):
     """Get the current session state"""
-    if session_id not in sessions:
+    state = await sessions.get(session_id)
+    if state is None:
         raise HTTPException(status_code=404, detail="Session not found")
-    return sessions[session_id]
+    return state
 
 @app.delete("/session/{session_id}")
 async def reset_session(session_id: str):
     """Reset a session"""
-    if session_id in sessions:
-        del sessions[session_id]
+    await sessions.delete(session_id)
     return {"success": True}
-
-import uvicorn
-
-if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8080)
\ No newline at end of file
@@ -35,12 +35,23 @@ class ExtractedDocument(BaseModel):
     data: Dict[str, Any]
     category: Optional[str] = None
 
+# Onboarding categories, in the order they are asked
+ONBOARDING_CATEGORIES = (
+    "current_symptoms",
+    "insurance",
+    "medication",
+    "health_record",
+    "review_data"
+)
+
 class OnboardingState(BaseModel):
     id: str
     current_question_index: int = 0
     awaiting_followup: bool = False
     last_question: Optional[str] = None
     previous_questions: List[Dict[str, Any]] = Field(default_factory=list)
+    # previous_questions rendered for LLM prompts, appended to by the agent
+    conversation_history: str = ""
     extracted_documents: List[ExtractedDocument] = Field(default_factory=list)
     
     # New fields for enhanced agent functionality
@@ -52,21 +63,9 @@ class OnboardingState(BaseModel):
     symptoms_info: Dict[str, Any] = Field(default_factory=dict)
     
     # Category-based approach fields
-    category_states: Dict[str, str] = Field(default_factory=lambda: {
-        "current_symptoms": "not_started",
-        "insurance": "not_started",
-        "medication": "not_started", 
-        "health_record": "not_started",
-        "review_data": "not_started"
-    })
+    category_states: Dict[str, str] = Field(default_factory=lambda: dict.fromkeys(ONBOARDING_CATEGORIES, "not_started"))
     current_category: str = "current_symptoms"
-    document_count: Dict[str, int] = Field(default_factory=lambda: {
-        "current_symptoms": 0,
-        "insurance": 0,
-        "medication": 0, 
-        "health_record": 0,
-        "review_data": 0
-    })
+    document_count: Dict[str, int] = Field(default_factory=lambda: dict.fromkeys(ONBOARDING_CATEGORIES, 0))
     
     # Fields for review data feature
     missing_data_items: List[str] = Field(default_factory=list)
@@ -1,9 +1,186 @@
 # backend/onboarding_agent.py
 from typing import Dict, List, Optional, Any, Tuple
-from models import OnboardingState, QuestionResponse, DocumentProcessResponse, ExtractedDocument
-from google import genai
+from models import OnboardingState, QuestionResponse, DocumentProcessResponse, ExtractedDocument, ONBOARDING_CATEGORIES
 from google.genai import types
+from document_processor import get_genai_client, gemini_rate_limiter
 import json
+import orjson
+from itertools import islice
+
+def _medication_answer(extracted_data: Dict[str, Any]) -> Optional[str]:
+    """Fallback answer listing the first medications found in a document"""
+    medications = extracted_data.get("medications")
+    if not medications:
+        return None
+    return f"Yes - medication found in document: {', '.join(m.get('name', '') for m in islice(medications, 2))}"
+
+def _health_record_answer(extracted_data: Dict[str, Any]) -> Optional[str]:
+    """Fallback answer summarizing the health records found in a document"""
+    health_records = extracted_data.get("health_records")
+    if health_records is None:
+        return None
+    
+    hospital_visits = health_records.get("hospital_visits")
+    if hospital_visits:
+        return f"Yes - health record found in document: {hospital_visits[0].get('name', 'Hospital visit')}"
+    diagnoses = health_records.get("diagnoses")
+    if diagnoses:
+        return f"Yes - health record found in document with diagnoses: {', '.join(d.get('condition', '') for d in islice(diagnoses, 2))}"
+    test_results = health_records.get("test_results")
+    if test_results:
+        return f"Yes - health record found in document with test results: {', '.join(t.get('name', '') for t in islice(test_results, 2))}"
+    return "Yes - health records found in document"
+
+# Question keyword -> fallback answer builder, checked in order
+_DOCUMENT_ANSWER_RULES = (
+    ("medication", _medication_answer),
+    ("doctor", _health_record_answer),
+)
+
+def _add_insurance_card(doc_type: str, data: Dict[str, Any], extracted_info: Dict[str, Any]) -> None:
+    """Extract insurance information from an insurance card"""
+    insurance = extracted_info.setdefault("insurance", {})
+    
+    # Add document type for reference
+    insurance["document_type"] = "Insurance Card"
+    
+    # Extract common insurance card fields
+    for field in ("provider", "policy_number", "group_number", "member_id", "coverage_type"):
+        if field in data:
+            insurance[field] = data[field]
+    
+    # Extract from policyholder and card_details if present
+    for section_name in ("policyholder", "card_details"):
+        section = data.get(section_name)
+        if isinstance(section, dict):
+            for field, value in section.items():
+                if field not in insurance:
+                    insurance[field] = value
+
+def _add_medication_box(doc_type: str, data: Dict[str, Any], extracted_info: Dict[str, Any]) -> None:
+    """Extract medications from active_ingredients or medication_details of a medication box"""
+    medications = extracted_info.setdefault("medications", [])
+    active_ingredients = data.get("active_ingredients")
+    med_details = data.get("medication_details")
+    if isinstance(active_ingredients, list):
+        for ingredient in active_ingredients:
+            medications.append({
+                "name": ingredient.get("name", "Unknown"),
+                "amount": ingredient.get("amount", ""),
+                "document_type": "Medication Box"
+            })
+    elif isinstance(med_details, dict):
+        medications.append({
+            "name": med_details.get("brand_name", "Unknown"),
+            "generic_name": med_details.get("generic_name", ""),
+            "strength": med_details.get("strength", ""),
+            "document_type": "Medication Box"
+        })
+
+def _add_prescription(doc_type: str, data: Dict[str, Any], extracted_info: Dict[str, Any]) -> None:
+    """Extract medications from prescribed_medications of a prescription"""
+    medications = extracted_info.setdefault("medications", [])
+    for med in data["prescribed_medications"]:
+        medications.append({
+            "name": med.get("name", "Unknown"),
+            "dosage": med.get("strength", ""),
+            "instructions": med.get("directions", ""),
+            "document_type": "Prescription"
+        })
+
+def _add_medication_plan(doc_type: str, data: Dict[str, Any], extracted_info: Dict[str, Any]) -> None:
+    """Extract medications from a medication plan"""
+    medications = extracted_info.setdefault("medications", [])
+    for med in data["medications"]:
+        medications.append({
+            "name": med.get("name", "Unknown"),
+            "dosage": med.get("dosage", ""),
+            "frequency": med.get("frequency", ""),
+            "timing": med.get("timing", ""),
+            "document_type": "Medication Plan"
+        })
+
+def _add_letter(doc_type: str, data: Dict[str, Any], extracted_info: Dict[str, Any]) -> None:
+    """Extract diagnoses and the hospital or doctor visit from a hospital or doctor letter"""
+    # Create health_records if not present
+    health_records = extracted_info.setdefault("health_records", {})
+    
+    # Extract diagnoses if present
+    diagnoses = data.get("diagnoses")
+    if isinstance(diagnoses, list):
+        record_diagnoses = health_records.setdefault("diagnoses", [])
+        
+        for diagnosis in diagnoses:
+            diag = {
+                "condition": diagnosis.get("diagnosis") or diagnosis.get("condition", "Unknown"),
+                "document_type": doc_type
+            }
+            if "details" in diagnosis:
+                diag["details"] = diagnosis["details"]
+            if "code" in diagnosis:
+                diag["code"] = diagnosis["code"]
+            
+            record_diagnoses.append(diag)
+    
+    # Extract hospital/doctor information
+    letter_metadata = data.get("letter_metadata")
+    if isinstance(letter_metadata, dict):
+        visit = {
+            "document_type": doc_type
+        }
+        
+        if doc_type == "HospitalLetter":
+            visit["name"] = letter_metadata.get("hospital_name", "Unknown Hospital")
+            visit["department"] = letter_metadata.get("hospital_department", "")
+        else:  # DoctorLetter
+            visit["name"] = letter_metadata.get("clinic_name", "Unknown Clinic")
+            visit["doctor"] = letter_metadata.get("doctor_name", "")
+        
+        visit["date"] = letter_metadata.get("date", "")
+        
+        health_records.setdefault("hospital_visits", []).append(visit)
+
+def _add_lab_report(doc_type: str, data: Dict[str, Any], extracted_info: Dict[str, Any]) -> None:
+    """Extract test results from a lab report"""
+    # Create health_records if not present
+    health_records = extracted_info.setdefault("health_records", {})
+    
+    # Extract test results
+    test_results = data.get("test_results")
+    if isinstance(test_results, list):
+        record_tests = health_records.setdefault("test_results", [])
+        
+        for test in test_results:
+            result = {
+                "name": test.get("test_name", "Unknown Test"),
+                "document_type": "Lab Report"
+            }
+            
+            if "value" in test:
+                result["value"] = test["value"]
+            
+            reference_range = test.get("reference_range")
+            if isinstance(reference_range, dict):
+                if "lower_limit" in reference_range and "upper_limit" in reference_range:
+                    result["reference_range"] = f"{reference_range['lower_limit']} - {reference_range['upper_limit']}"
+                elif "text_range" in reference_range:
+                    result["reference_range"] = reference_range["text_range"]
+            
+            if "flag" in test:
+                result["status"] = test["flag"]
+            
+            record_tests.append(result)
+
+# Document type -> function adding its data to the onboarding info
+_DOCUMENT_INFO_HANDLERS = {
+    "InsuranceCard": _add_insurance_card,
+    "MedicationBox": _add_medication_box,
+    "Prescription": _add_prescription,
+    "MedicationPlan": _add_medication_plan,
+    "HospitalLetter": _add_letter,
+    "DoctorLetter": _add_letter,
+    "LabReport": _add_lab_report,
+}
 
 class OnboardingAgent:
     """
@@ -12,13 +189,10 @@ class OnboardingAgent:
     """
     
     # Core categories for onboarding
-    CATEGORIES = [
-        "current_symptoms",
-        "insurance",
-        "medication",
-        "health_record",
-        "review_data"
-    ]
+    CATEGORIES = ONBOARDING_CATEGORIES
+    
+    # Position of each category, reported as the current question index
+    CATEGORY_INDEX = {category: index for index, category in enumerate(CATEGORIES)}
     
     # Questions for each category
     QUESTIONS = {
@@ -38,29 +212,42 @@ class OnboardingAgent:
         "review_data": "I'll check for any important health information that might be missing, such as medication details, vaccination status, or allergies."
     }
     
+    # Example documents to upload for each category
+    UPLOAD_EXAMPLES = {
+        "insurance": "insurance card, insurance policy documents, coverage statements",
+        "medication": "prescription, medication box, medication plan",
+        "health_record": "hospital letter, doctor's note, discharge summary, lab results, immunization records"
+    }
+    
+    # Follow-up prompts asking for more documents, built once per category
+    MORE_DOCUMENTS_PROMPTS = {
+        category: f"Do you have additional {category.replace('_', ' ')} documents to include? Type or click 'skip' if complete."
+        for category in CATEGORIES
+    }
+    
+    # Keyword fallbacks used when the LLM is unavailable (lowercase)
+    MORE_DOCUMENTS_POSITIVE = ("yes", "more", "another", "upload", "have")
+    MORE_DOCUMENTS_NEGATIVE = ("no", "done", "finished", "complete", "that's all", "that's it")
+    
     def __init__(self, document_processor):
         """Initialize the agent with a document processor and LLM client"""
         self.document_processor = document_processor
-        self.genai_client = genai.Client(
-            vertexai=True,
-            project="avi-cdtm-hack-team-9800",
-            location="us-central1",
-        )
+        self.genai_client = get_genai_client()
         self.model = "gemini-2.0-flash-001"
     
+    def _generate_content(self, **kwargs):
+        """Send a Gemini request once the process-wide rate limit allows it"""
+        gemini_rate_limiter.acquire()
+        return self.genai_client.models.generate_content(**kwargs)
+    
     def get_next_question(self, state: OnboardingState) -> QuestionResponse:
         """Generate a conversational prompt for the next question or document request"""
         current_category = state.current_category
         
-        # Ensure all categories are initialized in category_states
-        for category in self.CATEGORIES:
-            if category not in state.category_states:
-                state.category_states[category] = "not_started"
-                
-        # Also ensure document_count is initialized for all categories
+        # Ensure all categories are initialized in category_states and document_count
         for category in self.CATEGORIES:
-            if category not in state.document_count:
-                state.document_count[category] = 0
+            state.category_states.setdefault(category, "not_started")
+            state.document_count.setdefault(category, 0)
         
         # Check if we've completed all categories
         if all(state.category_states.get(cat) in ["enough_data", "not_enough_data"] for cat in self.CATEGORIES):
@@ -86,7 +273,7 @@ class OnboardingAgent:
                 message=conversational_q,
                 awaiting_followup=False,
                 done=False,
-                current_question_index=self.CATEGORIES.index(current_category),
+                current_question_index=self.CATEGORY_INDEX[current_category],
                 extracted_data=None
             )
         elif current_category == "review_data" and state.category_states[current_category] == "asked":
@@ -110,7 +297,7 @@ class OnboardingAgent:
                     message=prompt,
                     awaiting_followup=False,
                     done=False,
-                    current_question_index=self.CATEGORIES.index(current_category),
+                    current_question_index=self.CATEGORY_INDEX[current_category],
                     extracted_data=self._get_data_preview(state)
                 )
             else:
@@ -143,7 +330,7 @@ class OnboardingAgent:
                 message=conversational_q,
                 awaiting_followup=False,
                 done=False,
-                current_question_index=self.CATEGORIES.index(current_category),
+                current_question_index=self.CATEGORY_INDEX[current_category],
                 extracted_data=None
             )
             
@@ -157,7 +344,7 @@ class OnboardingAgent:
                 message=f"{question}",
                 awaiting_followup=False,
                 done=False,
-                current_question_index=self.CATEGORIES.index(current_category),
+                current_question_index=self.CATEGORY_INDEX[current_category],
                 extracted_data=None
             )
             
@@ -170,7 +357,7 @@ class OnboardingAgent:
                 message=clarification_q,
                 awaiting_followup=False,
                 done=False,
-                current_question_index=self.CATEGORIES.index(current_category),
+                current_question_index=self.CATEGORY_INDEX[current_category],
                 extracted_data=None
             )
             
@@ -182,7 +369,7 @@ class OnboardingAgent:
                 message=prompt,
                 awaiting_followup=True,
                 done=False,
-                current_question_index=self.CATEGORIES.index(current_category),
+                current_question_index=self.CATEGORY_INDEX[current_category],
                 extracted_data=self._get_data_preview(state)
             )
             
@@ -194,7 +381,7 @@ class OnboardingAgent:
                 message=prompt,
                 awaiting_followup=True,
                 done=False,
-                current_question_index=self.CATEGORIES.index(current_category),
+                current_question_index=self.CATEGORY_INDEX[current_category],
                 extracted_data=self._get_data_preview(state)
             )
             
@@ -227,6 +414,7 @@ class OnboardingAgent:
         
         # Store the last answer for potential clarification
         state.last_answer = answer
+        answer_lower = answer.lower()
         
         # Special handling for the review_data category
         if current_category == "review_data":
@@ -255,7 +443,7 @@ class OnboardingAgent:
                             message=prompt,
                             awaiting_followup=False,
                             done=False,
-                            current_question_index=self.CATEGORIES.index(current_category),
+                            current_question_index=self.CATEGORY_INDEX[current_category],
                             extracted_data=self._get_data_preview(state)
                         )
                     else:
@@ -305,7 +493,7 @@ class OnboardingAgent:
                             message=prompt,
                             awaiting_followup=False,
                             done=False,
-                            current_question_index=self.CATEGORIES.index(current_category),
+                            current_question_index=self.CATEGORY_INDEX[current_category],
                             extracted_data=self._get_data_preview(state)
                         )
                     else:
@@ -349,7 +537,7 @@ class OnboardingAgent:
             return self.get_next_question(state)
         
         # Check for skip response at any stage
-        if answer.lower() == "skip":
+        if answer_lower == "skip":
             # Special handling for review_data category when skipping
             if current_category == "review_data":
                 if category_state == "in_progress":
@@ -365,7 +553,7 @@ class OnboardingAgent:
                                 message=prompt,
                                 awaiting_followup=False,
                                 done=False,
-                                current_question_index=self.CATEGORIES.index(current_category),
+                                current_question_index=self.CATEGORY_INDEX[current_category],
                                 extracted_data=self._get_data_preview(state)
                             )
                         else:
@@ -476,7 +664,7 @@ class OnboardingAgent:
             # If still not clear, keep asking (but limit to one retry)
             if not is_clear:
                 # Just accept it and move on to avoid frustration
-                response_type = "no" if "no" in answer.lower() else "yes"
+                response_type = "no" if "no" in answer_lower else "yes"
             
             # Process the clarified answer
             if response_type in ["strong_yes", "yes"]:
@@ -523,7 +711,7 @@ class OnboardingAgent:
 
     def _move_to_next_category(self, state):
         """Find and move to the next unprocessed category"""
-        current_index = self.CATEGORIES.index(state.current_category)
+        current_index = self.CATEGORY_INDEX[state.current_category]
         
         # Try categories after the current one
         for i in range(current_index + 1, len(self.CATEGORIES)):
@@ -679,7 +867,7 @@ class OnboardingAgent:
     def _generate_more_documents_prompt(self, category: str, state: OnboardingState) -> str:
         """Generate a prompt asking if user has more documents for the current category"""
         # Use a direct, focused message
-        return f"Do you have additional {category.replace('_', ' ')} documents to include? Type or click 'skip' if complete."
+        return self.MORE_DOCUMENTS_PROMPTS[category]
 
     def _check_has_more_documents(self, answer: str) -> bool:
         """Check if user indicated they have more documents to upload"""
@@ -694,7 +882,7 @@ class OnboardingAgent:
         """
         
         try:
-            response = self.genai_client.models.generate_content(
+            response = self._generate_content(
                 model=self.model,
                 contents=prompt,
                 config={"temperature": 0.1}
@@ -708,21 +896,13 @@ class OnboardingAgent:
             
             # Fallback check
             answer_lower = answer.lower()
-            positive_indicators = ["yes", "more", "another", "upload", "have"]
-            negative_indicators = ["no", "done", "finished", "complete", "that's all", "that's it"]
             
             # Check for negative indicators first (they take priority)
-            for word in negative_indicators:
-                if word in answer_lower:
-                    return False
+            if any(word in answer_lower for word in self.MORE_DOCUMENTS_NEGATIVE):
+                return False
                     
-            # Then check for positive indicators
-            for word in positive_indicators:
-                if word in answer_lower:
-                    return True
-                    
-            # Default to no more documents if unclear
-            return False
+            # Then check for positive indicators, defaulting to no more documents if unclear
+            return any(word in answer_lower for word in self.MORE_DOCUMENTS_POSITIVE)
 
     def _generate_upload_prompt(self, category: str, state: OnboardingState) -> str:
         """Generate a prompt asking the user to upload a relevant document"""
@@ -733,14 +913,7 @@ class OnboardingAgent:
             self._move_to_next_category(state)
             return self.get_next_question(state).message
             
-        examples = ""
-        
-        if category == "insurance":
-            examples = "insurance card, insurance policy documents, coverage statements"
-        elif category == "medication":
-            examples = "prescription, medication box, medication plan"
-        elif category == "health_record":
-            examples = "hospital letter, doctor's note, discharge summary, lab results, immunization records"
+        examples = self.UPLOAD_EXAMPLES.get(category, "")
         
         # Use a direct message that clearly indicates both upload and skip options
         return f"Please upload your {category.replace('_', ' ')} documents (e.g., {examples}) for your general practice appointment. Click 'Skip' to continue without uploading."
@@ -777,7 +950,7 @@ class OnboardingAgent:
         }
         
         try:
-            response = self.genai_client.models.generate_content(
+            response = self._generate_content(
                 model=self.model,
                 contents=prompt,
                 config={
@@ -787,8 +960,10 @@ class OnboardingAgent:
                 }
             )
             
-            # Parse the JSON response
-            result = json.loads(response.text)
+            # The SDK already decodes responses with a schema into response.parsed
+            result = response.parsed
+            if result is None:
+                raise ValueError(f"Response is not valid JSON: {response.text}")
             is_clear = result.get("is_clear", False)
             response_type = result.get("response_type", "unsure")
             
@@ -798,9 +973,10 @@ class OnboardingAgent:
             print(f"Error evaluating answer: {e}")
             
             # Fallback evaluation
-            if "yes" in answer.lower():
+            answer_lower = answer.lower()
+            if "yes" in answer_lower:
                 return True, "yes"
-            elif "no" in answer.lower():
+            elif "no" in answer_lower:
                 return True, "no"
             else:
                 return False, "unsure"    
@@ -812,10 +988,7 @@ class OnboardingAgent:
             return "I'm Shelly, your medical assistant. I'll help you prepare the necessary documents for your general practice appointment. To get started, please tell me what brings you in today."
             
         # Get the history of previous questions and answers
-        history = ""
-        for item in state.previous_questions:
-            if item.get("question") and item.get("answer"):
-                history += f"- Question: {item['question']}\n  Answer: {item['answer']}\n"
+        history = state.conversation_history
         
         prompt = f"""
         You are Shelly, a medical assistant helping a patient prepare documents for their general practice appointment.
@@ -840,7 +1013,7 @@ class OnboardingAgent:
         """
         
         try:
-            response = self.genai_client.models.generate_content(
+            response = self._generate_content(
                 model=self.model,
                 contents=prompt,
                 config={"temperature": 0.7}
@@ -880,7 +1053,7 @@ class OnboardingAgent:
         """
         
         try:
-            response = self.genai_client.models.generate_content(
+            response = self._generate_content(
                 model=self.model,
                 contents=prompt,
                 config={"temperature": 0.7}
@@ -908,7 +1081,7 @@ class OnboardingAgent:
         """
         
         try:
-            response = self.genai_client.models.generate_content(
+            response = self._generate_content(
                 model=self.model,
                 contents=prompt,
                 config={"temperature": 0.3}
@@ -918,22 +1091,14 @@ class OnboardingAgent:
         except Exception as e:
             print(f"Error generating document-based answer: {e}")
             
-            # Fallback answer
-            if "medication" in question.lower() and extracted_data.get("medications"):
-                return f"Yes - medication found in document: {', '.join(m.get('name', '') for m in extracted_data.get('medications', [])[:2])}"
-            elif "doctor" in question.lower() and "health_records" in extracted_data:
-                health_records = extracted_data.get("health_records", {})
-                
-                if "hospital_visits" in health_records and health_records["hospital_visits"]:
-                    return f"Yes - health record found in document: {health_records.get('hospital_visits', [{}])[0].get('name', 'Hospital visit')}"
-                elif "diagnoses" in health_records and health_records["diagnoses"]:
-                    return f"Yes - health record found in document with diagnoses: {', '.join(d.get('condition', '') for d in health_records.get('diagnoses', [])[:2])}"
-                elif "test_results" in health_records and health_records["test_results"]:
-                    return f"Yes - health record found in document with test results: {', '.join(t.get('name', '') for t in health_records.get('test_results', [])[:2])}"
-                else:
-                    return "Yes - health records found in document"
-            else:
-                return "Yes - details found in document"
+            # Fallback answer from the first rule whose keyword appears in the question
+            question_lower = question.lower()
+            for keyword, build_answer in _DOCUMENT_ANSWER_RULES:
+                if keyword in question_lower:
+                    answer = build_answer(extracted_data)
+                    if answer:
+                        return answer
+            return "Yes - details found in document"
     
     def _generate_summary(self, state: OnboardingState) -> str:
         """Generate a summary of the onboarding information"""
@@ -1016,7 +1181,7 @@ class OnboardingAgent:
         """
         
         try:
-            response = self.genai_client.models.generate_content(
+            response = self._generate_content(
                 model=self.model,
                 contents=prompt,
                 config={"temperature": 0.7}
@@ -1063,180 +1228,28 @@ class OnboardingAgent:
             }
         
         for doc_type, group in result.document_groups.items():
-            if not group.combined_data:
-                continue
-                
             data = group.combined_data
+            if not data:
+                continue
             
             # Process based on document type
-            if doc_type == "InsuranceCard":
-                # Extract insurance information
-                if "insurance" not in extracted_info:
-                    extracted_info["insurance"] = {}
-                
-                # Add document type for reference
-                extracted_info["insurance"]["document_type"] = "Insurance Card"
-                
-                # Extract common insurance card fields
-                insurance_fields = ["provider", "policy_number", "group_number", "member_id", "coverage_type"]
-                for field in insurance_fields:
-                    if field in data:
-                        extracted_info["insurance"][field] = data[field]
-                
-                # Extract from policyholder if present
-                if "policyholder" in data and isinstance(data["policyholder"], dict):
-                    for field, value in data["policyholder"].items():
-                        if field not in extracted_info["insurance"]:
-                            extracted_info["insurance"][field] = value
-                
-                # Extract from card_details if present
-                if "card_details" in data and isinstance(data["card_details"], dict):
-                    for field, value in data["card_details"].items():
-                        if field not in extracted_info["insurance"]:
-                            extracted_info["insurance"][field] = value
-                            
-            elif doc_type == "MedicationBox" or doc_type == "Prescription" or doc_type == "MedicationPlan":
-                if "medications" not in extracted_info:
-                    extracted_info["medications"] = []
-                
-                # For MedicationBox, extract from active_ingredients or medication_details
-                if doc_type == "MedicationBox":
-                    if "active_ingredients" in data and isinstance(data["active_ingredients"], list):
-                        for ingredient in data["active_ingredients"]:
-                            med = {
-                                "name": ingredient.get("name", "Unknown"),
-                                "amount": ingredient.get("amount", ""),
-                                "document_type": "Medication Box"
-                            }
-                            extracted_info["medications"].append(med)
-                    elif "medication_details" in data and isinstance(data["medication_details"], dict):
-                        med_details = data["medication_details"]
-                        med = {
-                            "name": med_details.get("brand_name", "Unknown"),
-                            "generic_name": med_details.get("generic_name", ""),
-                            "strength": med_details.get("strength", ""),
-                            "document_type": "Medication Box"
-                        }
-                        extracted_info["medications"].append(med)
-                
-                # For Prescription, extract from prescribed_medications
-                elif doc_type == "Prescription":
-                    for med in data["prescribed_medications"]:
-                        medication = {
-                            "name": med.get("name", "Unknown"),
-                            "dosage": med.get("strength", ""),
-                            "instructions": med.get("directions", ""),
-                            "document_type": "Prescription"
-                        }
-                        extracted_info["medications"].append(medication)
-                
-                # For MedicationPlan, extract from medications
-                elif doc_type == "MedicationPlan":
-                    for med in data["medications"]:
-                        medication = {
-                            "name": med.get("name", "Unknown"),
-                            "dosage": med.get("dosage", ""),
-                            "frequency": med.get("frequency", ""),
-                            "timing": med.get("timing", ""),
-                            "document_type": "Medication Plan"
-                        }
-                        extracted_info["medications"].append(medication)
-            
-            elif doc_type == "HospitalLetter" or doc_type == "DoctorLetter":
-                # Create health_records if not present
-                if "health_records" not in extracted_info:
-                    extracted_info["health_records"] = {}
-                
-                # Extract diagnoses if present
-                if "diagnoses" in data and isinstance(data["diagnoses"], list):
-                    if "diagnoses" not in extracted_info["health_records"]:
-                        extracted_info["health_records"]["diagnoses"] = []
-                    
-                    for diagnosis in data["diagnoses"]:
-                        diag = {
-                            "condition": diagnosis.get("diagnosis") or diagnosis.get("condition", "Unknown"),
-                            "document_type": doc_type
-                        }
-                        if "details" in diagnosis:
-                            diag["details"] = diagnosis["details"]
-                        if "code" in diagnosis:
-                            diag["code"] = diagnosis["code"]
-                        
-                        extracted_info["health_records"]["diagnoses"].append(diag)
-                
-                # Extract hospital/doctor information
-                if "letter_metadata" in data and isinstance(data["letter_metadata"], dict):
-                    if "hospital_visits" not in extracted_info["health_records"]:
-                        extracted_info["health_records"]["hospital_visits"] = []
-                    
-                    visit = {
-                        "document_type": doc_type
-                    }
-                    
-                    if doc_type == "HospitalLetter":
-                        visit["name"] = data["letter_metadata"].get("hospital_name", "Unknown Hospital")
-                        visit["department"] = data["letter_metadata"].get("hospital_department", "")
-                    else:  # DoctorLetter
-                        visit["name"] = data["letter_metadata"].get("clinic_name", "Unknown Clinic")
-                        visit["doctor"] = data["letter_metadata"].get("doctor_name", "")
-                    
-                    visit["date"] = data["letter_metadata"].get("date", "")
-                    
-                    extracted_info["health_records"]["hospital_visits"].append(visit)
-                    
-            elif doc_type == "LabReport":
-                # Create health_records if not present
-                if "health_records" not in extracted_info:
-                    extracted_info["health_records"] = {}
-                
-                # Extract test results
-                if "test_results" in data and isinstance(data["test_results"], list):
-                    if "test_results" not in extracted_info["health_records"]:
-                        extracted_info["health_records"]["test_results"] = []
-                    
-                    for test in data["test_results"]:
-                        result = {
-                            "name": test.get("test_name", "Unknown Test"),
-                            "document_type": "Lab Report"
-                        }
-                        
-                        if "value" in test:
-                            result["value"] = test["value"]
-                        
-                        if "reference_range" in test and isinstance(test["reference_range"], dict):
-                            range_text = []
-                            if "lower_limit" in test["reference_range"] and "upper_limit" in test["reference_range"]:
-                                range_text.append(f"{test['reference_range']['lower_limit']} - {test['reference_range']['upper_limit']}")
-                            elif "text_range" in test["reference_range"]:
-                                range_text.append(test["reference_range"]["text_range"])
-                            
-                            if range_text:
-                                result["reference_range"] = ", ".join(range_text)
-                        
-                        if "flag" in test:
-                            result["status"] = test["flag"]
-                        
-                        extracted_info["health_records"]["test_results"].append(result)
-            
-            # Add patient info from any document type
-            if "patient_information" in data and isinstance(data["patient_information"], dict):
-                if "patient" not in extracted_info:
-                    extracted_info["patient"] = {}
+            handler = _DOCUMENT_INFO_HANDLERS.get(doc_type)
+            if handler is not None:
+                handler(doc_type, data, extracted_info)
+            
+            # Add patient info from any document type, falling back to policyholder
+            # info which might contain patient details
+            patient_source = data.get("patient_information")
+            if not isinstance(patient_source, dict):
+                patient_source = data.get("policyholder")
+            
+            if isinstance(patient_source, dict):
+                patient = extracted_info.setdefault("patient", {})
                 
                 # Copy patient information fields
-                for field, value in data["patient_information"].items():
-                    if field not in extracted_info["patient"] or not extracted_info["patient"][field]:
-                        extracted_info["patient"][field] = value
-            
-            # Also check for policyholder info which might contain patient details
-            elif "policyholder" in data and isinstance(data["policyholder"], dict):
-                if "patient" not in extracted_info:
-                    extracted_info["patient"] = {}
-                
-                # Copy policyholder information as patient info
-                for field, value in data["policyholder"].items():
-                    if field not in extracted_info["patient"] or not extracted_info["patient"][field]:
-                        extracted_info["patient"][field] = value
+                for field, value in patient_source.items():
+                    if not patient.get(field):
+                        patient[field] = value
         
         return extracted_info
     
@@ -1247,6 +1260,10 @@ class OnboardingAgent:
             "answer": answer,
             "followup": followup_file
         })
+        
+        # Extend the rendered history once here instead of rebuilding it for every prompt
+        if question and answer:
+            state.conversation_history += f"- Question: {question}\n  Answer: {answer}\n"
         return state
     
     def _get_data_preview(self, state: OnboardingState) -> Dict[str, Any]:
@@ -1399,7 +1416,7 @@ class OnboardingAgent:
         """
         
         try:
-            response = self.genai_client.models.generate_content(
+            response = self._generate_content(
                 model=self.model,
                 contents=prompt,
                 config={"temperature": 0.1}
@@ -1423,14 +1440,14 @@ class OnboardingAgent:
             
             try:
                 # Try to parse directly
-                extracted_info = json.loads(clean_response)
-            except json.JSONDecodeError:
+                extracted_info = orjson.loads(clean_response)
+            except orjson.JSONDecodeError:
                 # If that fails, try to extract just the JSON part
                 json_start = clean_response.find("{")
                 json_end = clean_response.rfind("}") + 1
                 if json_start >= 0 and json_end > json_start:
                     json_text = clean_response[json_start:json_end]
-                    extracted_info = json.loads(json_text)
+                    extracted_info = orjson.loads(json_text)
                 else:
                     # If we can't find valid JSON, create a minimal structure
                     return []
@@ -1468,7 +1485,7 @@ class OnboardingAgent:
         """
         
         try:
-            response = self.genai_client.models.generate_content(
+            response = self._generate_content(
                 model=self.model,
                 contents=prompt,
                 config={"temperature": 0.3}
@@ -1572,7 +1589,7 @@ class OnboardingAgent:
         """
         
         try:
-            response = self.genai_client.models.generate_content(
+            response = self._generate_content(
                 model=self.model,
                 contents=prompt,
                 config={"temperature": 0.1}
@@ -1602,15 +1619,15 @@ class OnboardingAgent:
             
             try:
                 # Try to parse directly
-                extracted_info = json.loads(clean_response)
+                extracted_info = orjson.loads(clean_response)
                 missing_data = extracted_info.get("missing_data", [])
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 # If that fails, try to extract just the JSON part
                 json_start = clean_response.find("{")
                 json_end = clean_response.rfind("}") + 1
                 if json_start >= 0 and json_end > json_start:
                     json_text = clean_response[json_start:json_end]
-                    extracted_info = json.loads(json_text)
+                    extracted_info = orjson.loads(json_text)
                     missing_data = extracted_info.get("missing_data", [])
                 else:
                     # If we can't find valid JSON, return empty list
@@ -1659,7 +1676,7 @@ class OnboardingAgent:
         """
         
         try:
-            response = self.genai_client.models.generate_content(
+            response = self._generate_content(
                 model=self.model,
                 contents=prompt,
                 config={"temperature": 0.7}
@@ -1719,7 +1736,7 @@ class OnboardingAgent:
         """
         
         try:
-            response = self.genai_client.models.generate_content(
+            response = self._generate_content(
                 model=self.model,
                 contents=prompt,
                 config={"temperature": 0.5}
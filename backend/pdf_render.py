@@ -0,0 +1,30 @@
+# backend/pdf_render.py
+# PDF rendering for the render worker processes. Kept apart from the application modules,
+# so workers only import pypdfium2 and Pillow.
+import io
+from typing import Union
+import pypdfium2 as pdfium
+
+def render_page(pdf: Union[str, bytes], page_index: int, scale: float, max_side: int, quality: int) -> bytes:
+    """Render a single page of a PDF, given as file path or bytes, to JPEG bytes"""
+    pdf = pdfium.PdfDocument(pdf)
+    try:
+        page = pdf[page_index]
+        # Large pages are rendered at no more than max_side pixels per side right away,
+        # so the image is encoded only once
+        scale = min(scale, max_side / max(page.get_size()))
+        image = page.render(scale=scale).to_pil()
+    finally:
+        pdf.close()
+
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+def count_pages(pdf: Union[str, bytes]) -> int:
+    """Number of pages of a PDF, given as file path or bytes"""
+    pdf = pdfium.PdfDocument(pdf)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
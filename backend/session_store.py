@@ -0,0 +1,75 @@
+# backend/session_store.py
+import asyncio
+import os
+import weakref
+from typing import Optional
+from cachetools import TTLCache
+from models import OnboardingState
+
+# Sessions expire after an hour without requests, so abandoned ones don't pile up
+SESSION_TTL_SECONDS = 60 * 60
+MAX_SESSIONS = 10_000
+
+# Upper bound for holding a session lock in Redis, so a crashed worker can't block a session
+# forever; it has to outlast the longest request, which is document processing
+SESSION_LOCK_TIMEOUT_SECONDS = 5 * 60
+
+class MemorySessionStore:
+    """Sessions kept in process memory; only consistent with a single server worker"""
+
+    def __init__(self):
+        self._sessions = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL_SECONDS)
+        # Locks are dropped once no request holds or waits for them
+        self._locks = weakref.WeakValueDictionary()
+
+    def lock(self, session_id: str) -> asyncio.Lock:
+        """Lock serializing the requests of one session"""
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        return lock
+
+    async def get(self, session_id: str) -> Optional[OnboardingState]:
+        return self._sessions.get(session_id)
+
+    async def put(self, state: OnboardingState) -> None:
+        # TTLCache counts from insertion, so writing the state back restarts its expiry timer
+        self._sessions[state.id] = state
+
+    async def delete(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+class RedisSessionStore:
+    """Sessions stored as JSON in Redis, shared by every server worker"""
+
+    def __init__(self, url: str):
+        # Optional dependency, only needed when sessions are stored in Redis
+        import redis.asyncio as redis
+        self._redis = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"sess:{session_id}"
+
+    def lock(self, session_id: str):
+        """Lock serializing the requests of one session across all server workers"""
+        return self._redis.lock(f"sess-lock:{session_id}", timeout=SESSION_LOCK_TIMEOUT_SECONDS)
+
+    async def get(self, session_id: str) -> Optional[OnboardingState]:
+        data = await self._redis.get(self._key(session_id))
+        if data is None:
+            return None
+        return OnboardingState.model_validate_json(data)
+
+    async def put(self, state: OnboardingState) -> None:
+        await self._redis.set(self._key(state.id), state.model_dump_json(), ex=SESSION_TTL_SECONDS)
+
+    async def delete(self, session_id: str) -> None:
+        await self._redis.delete(self._key(session_id))
+
+def create_session_store():
+    """Use Redis when SESSION_REDIS_URL is set, so several workers can serve one session"""
+    redis_url = os.getenv("SESSION_REDIS_URL")
+    if redis_url:
+        return RedisSessionStore(redis_url)
+    return MemorySessionStore()